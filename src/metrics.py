@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+'''
+Usage: python3 metrics.py <socket>
+Collects the throughput of all pipes of a pipeline and sends it to InfluxDB every few seconds.
+Every pipe connects to the unix socket, sends its name on the first line and then copies the data flowing through it.
+The InfluxDB write endpoint can be changed with the INFLUXDB_URL environment variable.
+'''
+import asyncio
+import collections
+import http.client
+import os
+import signal
+import sys
+import threading
+import time
+import urllib.parse
+
+INFLUXDB_URL = os.environ.get("INFLUXDB_URL", "http://localhost:8086/write?db=pipeliner")
+INTERVAL = 1
+# Send the points once there are BATCH of them, or at least every FLUSH_INTERVAL seconds
+BATCH = 16
+FLUSH_INTERVAL = 2
+
+# Bytes read from each pipe since the last report
+counts = {}
+# Points waiting to be sent
+pending = collections.deque()
+
+def eprint(*args, **kwargs):
+  print(*args, file=sys.stderr, **kwargs)
+
+# Tag values in the line protocol need commas, spaces and equal signs escaped
+def escape(tag):
+  return tag.replace(",", "\\,").replace(" ", "\\ ").replace("=", "\\=")
+
+class Influx:
+  def __init__(self, url):
+    url = urllib.parse.urlsplit(url)
+    self.path = url.path + (f"?{url.query}" if url.query else "")
+    connection = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+    # The connection is kept open between the writes
+    self.connection = connection(url.hostname, url.port)
+    # The final write on exit may come while a periodic one is still running in the executor
+    self.lock = threading.Lock()
+
+  def write(self, lines):
+    with self.lock:
+      try:
+        self.connection.request("POST", self.path, body="\n".join(lines).encode())
+        self.connection.getresponse().read()
+      except (OSError, http.client.HTTPException) as e:
+        eprint(f"Failed to write metrics to InfluxDB: {e}")
+        # reconnects on the next request
+        self.connection.close()
+
+# Counts the bytes of one pipe. The data is read into a single large buffer shared by all pipes
+# and thrown away, so a read moves up to 1 MiB without allocating anything.
+class Collector(asyncio.BufferedProtocol):
+  buffer = bytearray(1 << 20)
+
+  def __init__(self):
+    self.name = None
+    self.header = b""
+
+  def get_buffer(self, sizehint):
+    return self.buffer
+
+  def buffer_updated(self, nbytes):
+    if self.name is None:
+      # the name of the pipe is on the first line
+      self.header += self.buffer[:nbytes]
+      if b"\n" not in self.header:
+        return
+      name, _, data = self.header.partition(b"\n")
+      self.name = name.decode().strip()
+      counts.setdefault(self.name, 0)
+      nbytes = len(data)
+    counts[self.name] += nbytes
+
+# Take a point per pipe with the bytes read since the last sample
+def sample():
+  timestamp = time.time_ns()
+  pending.extend(f"pipes,pipe={escape(name)} bytes={count}i {timestamp}" for name, count in counts.items())
+  for name in counts:
+    counts[name] = 0
+
+# Points are sampled every INTERVAL, but sent in batches of several seconds. The line protocol is newline separated.
+async def report(influx):
+  loop = asyncio.get_running_loop()
+  lastFlush = time.monotonic()
+  while True:
+    await asyncio.sleep(INTERVAL)
+    sample()
+    if len(pending) >= BATCH or time.monotonic() - lastFlush >= FLUSH_INTERVAL:
+      lines = list(pending)
+      pending.clear()
+      lastFlush = time.monotonic()
+      if lines:
+        await loop.run_in_executor(None, influx.write, lines)
+
+async def main(path):
+  loop = asyncio.get_running_loop()
+  influx = Influx(INFLUXDB_URL)
+  server = await loop.create_unix_server(Collector, path)
+  reporting = asyncio.ensure_future(report(influx))
+
+  # The pipeline terminates its children on exit, send the points that were not sent yet
+  stop = loop.create_future()
+  for sig in (signal.SIGINT, signal.SIGTERM):
+    loop.add_signal_handler(sig, lambda: stop.done() or stop.set_result(None))
+  await stop
+  reporting.cancel()
+  server.close()
+  sample()
+  if pending:
+    influx.write(list(pending))
+
+if __name__ == '__main__':
+  asyncio.run(main(sys.argv[1]))
@@ -23,10 +23,8 @@ import glob
 import sys
 import os
 import socket
-import threading
-import queue
+import selectors
 import time
-import select
 import logging
 import pathlib
 
@@ -35,69 +33,114 @@ def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
-class Socket(threading.Thread):
+# Previews are only watched with tail, they are appended to without updating the access time
+def open_preview(path, buffering=1 << 20):
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND
+    try:
+        fd = os.open(path, flags | getattr(os, 'O_NOATIME', 0), 0o644)
+    except PermissionError:
+        # O_NOATIME is only allowed to the owner of the file
+        fd = os.open(path, flags, 0o644)
+    return os.fdopen(fd, 'wb', buffering=buffering)
+
+
+class Socket:
     def __init__(self, preview, port):
-        threading.Thread.__init__(self)
         self.preview = preview
         self.port = port
-        self.queue = queue.Queue()
-        self.read = False
-        self.is_running = True
+        self.server = None
 
-    def run(self):
-        while True:
+    # Start listening; returns False if the port is not available yet
+    def open(self, sel):
+        try:
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.bind(('0.0.0.0', self.port))
+            server.listen()
+            # a connection may be gone again before it is accepted, don't block on it
+            server.setblocking(False)
+        except OSError:
+            server.close()
+            logging.error(f'port {self.port} in use, retrying to connect...')
+            return False
+        self.server = server
+        self.preview_file = open_preview(self.preview)
+        sel.register(server, selectors.EVENT_READ, self)
+        logging.debug(f'waiting for a connection on port {self.port}')
+        return True
+
+    # Called when the server or the connection is readable; returns the data read, if any
+    def handle(self, sel, fileobj):
+        if fileobj is self.server:
             try:
-                server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                server.setblocking(False)
-                server.bind(('0.0.0.0', self.port))
-                server.listen()
-                break
-            except:
-                logging.error(f'port {self.port} in use, retrying to connect...')
-                time.sleep(1)
-
-
-        with open(self.preview, 'wb') as preview:
-            while self.is_running:
-                try:
-                    ready = select.select([server],[],[],1)
-                    logging.debug(f'waiting for a connection on port {self.port}')
-                    if not ready[0]:
-                        continue
-                    conn, _ = server.accept()
-                    logging.debug(f'got connection on port {self.port}')
-                    conn.setblocking(False)
-                    with conn:
-                        while self.is_running:
-                            ready = select.select([conn],[],[],1)
-                            if not ready[0]:
-                                continue
-                            data = conn.recv(1024)
-                            if not data:
-                                break
-                            if self.read:
-                                self.queue.put(data)
-                            preview.write(data)
-                            preview.flush()
-                except socket.error:
-                    logging.error(f'connection error on port {self.port}')
-                    continue
-
-class Stdin(threading.Thread):
+                conn, _ = self.server.accept()
+            except BlockingIOError:
+                return None
+            except OSError as e:
+                logging.error(f'failed to accept a connection on port {self.port}: {e}')
+                return None
+            conn.setblocking(True)
+            logging.debug(f'got connection on port {self.port}')
+            # serve one connection at a time, the others wait in the backlog
+            sel.unregister(self.server)
+            sel.register(conn, selectors.EVENT_READ, self)
+            return None
+        try:
+            data = fileobj.recv(65536)
+        except socket.error:
+            logging.error(f'connection error on port {self.port}')
+            data = b''
+        if not data:
+            sel.unregister(fileobj)
+            fileobj.close()
+            sel.register(self.server, selectors.EVENT_READ, self)
+            logging.debug(f'waiting for a connection on port {self.port}')
+            return None
+        self.preview_file.write(data)
+        return data
+
+    # Previews are only for watching, they are flushed periodically rather than per chunk
+    def flush(self):
+        if self.server is not None:
+            self.preview_file.flush()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.preview_file.close()
+
+class Stdin:
     def __init__(self, preview):
-        threading.Thread.__init__(self)
         self.preview = preview
-        self.queue = queue.Queue()
-        self.read = False
-
-    def run(self):
-        with open(self.preview, 'wb') as preview:
-            while True:
-                data = sys.stdin.buffer.read(1024)
-                if self.read:
-                    self.queue.put(data)
-                preview.write(data)
-                preview.flush()
+        self.fd = sys.stdin.buffer.fileno()
+        # set when stdin can't be selected on and is read on every turn of the loop instead
+        self.unselectable = False
+
+    def open(self, sel):
+        self.preview_file = open_preview(self.preview)
+        try:
+            sel.register(self.fd, selectors.EVENT_READ, self)
+        except PermissionError:
+            # epoll refuses regular files (octocat.py < file), they are always readable anyway
+            self.unselectable = True
+        return True
+
+    def handle(self, sel, fileobj):
+        data = os.read(self.fd, 65536)
+        if not data:
+            logging.debug('end of STD IN')
+            if self.unselectable:
+                self.unselectable = False
+            else:
+                sel.unregister(self.fd)
+            return None
+        self.preview_file.write(data)
+        return data
+
+    def flush(self):
+        self.preview_file.flush()
+
+    def close(self):
+        self.preview_file.close()
 
 def load_inputs():
     inputs = {}
@@ -114,17 +157,38 @@ def load_inputs():
             logging.debug(f'input {f}: socket on port {port}')
     return inputs
 
+# With stdin as the only input there is nothing to select from, just copy it to stdout and its preview
+def copy_stdin(input):
+    buf = bytearray(65536)
+    view = memoryview(buf)
+    with open_preview(input.preview, buffering=0) as preview:
+        while True:
+            n = os.readv(input.fd, [buf])
+            if not n:
+                logging.debug('end of STD IN')
+                break
+            sys.stdout.buffer.write(view[:n])
+            sys.stdout.buffer.flush()
+            preview.write(view[:n])
+
 class Selector:
     def __init__(self):
         self.select_last_read_stamp = 0
         self.select_last_read = None
+        self.select_last_value = None
 
+    # SELECT is only re-read when its mtime changes; rewriting it with the same value changes nothing
     def read_select(self, inputs):
         try:
             stamp = os.stat('SELECT').st_mtime
             if self.select_last_read_stamp == 0 or stamp != self.select_last_read_stamp:
-                s = open('SELECT').readline().strip()
+                with open('SELECT') as f:
+                    s = f.readline().strip()
+                if s == self.select_last_value:
+                    self.select_last_read_stamp = stamp
+                    return self.select_last_read
                 selected = inputs[s]
+                self.select_last_value = s
                 self.select_last_read_stamp = stamp
                 self.select_last_read = selected
                 logging.info(f'read SELECT, will now follow {s} ({selected})')
@@ -147,44 +211,52 @@ def main(args):
 
     inputs = load_inputs()
 
-    for _, input in inputs.items():
-        input.start()
+    if len(inputs) == 1 and isinstance(list(inputs.values())[0], Stdin):
+        try:
+            copy_stdin(list(inputs.values())[0])
+        except KeyboardInterrupt:
+            pass
+        return
+
+    # A single IO loop: sleep in the kernel until one of the inputs is readable
+    sel = selectors.DefaultSelector()
+    pending = [input for input in inputs.values() if not input.open(sel)]
 
     selector = Selector()
     select = selector.read_select(inputs)
-    select.read = True
-    select2 = None
-    while True:    
-        try:
-            start = time.time()
-            read_len = 0
-            while True:
-                try:
-                    data = select.queue.get(timeout=args.interval)
+    start = time.time()
+    read_len = 0
+    try:
+        while True:
+            written = False
+            # inputs that can't be selected on are always ready, so don't sleep while there are any
+            unselectable = [input for input in inputs.values() if isinstance(input, Stdin) and input.unselectable]
+            ready = [(key.data, key.fileobj) for key, _ in sel.select(timeout=0 if unselectable else args.interval)]
+            for input, fileobj in ready + [(input, input.fd) for input in unselectable]:
+                data = input.handle(sel, fileobj)
+                if data and input is select:
                     read_len += len(data)
                     sys.stdout.buffer.write(data)
-                    sys.stdout.buffer.flush()
-                except queue.Empty:
-                    if select2 is not None:
-                        read_len = 0
-                        select = select2
-                        select2 = None
-                        logging.debug('changed source')
-                        break
-                if time.time() - start > args.interval:
-                    logging.debug(f'read {read_len} bytes during last {time.time() - start} seconds')
-                    select2 = selector.read_select(inputs)
-                    if select2 != select:
-                        select.read = False
-                        select2.read = True
-                    else:
-                        select2 = None
-        except KeyboardInterrupt:
-            for _, input in inputs.items():
-                input.is_running = False
-            for _, input in inputs.items():
-                input.join()
-            break
+                    written = True
+            # one flush for everything that was ready, not one per chunk
+            if written:
+                sys.stdout.buffer.flush()
+            if time.time() - start > args.interval:
+                logging.debug(f'read {read_len} bytes during last {time.time() - start} seconds')
+                for _, input in inputs.items():
+                    input.flush()
+                pending = [input for input in pending if not input.open(sel)]
+                select2 = selector.read_select(inputs)
+                if select2 != select:
+                    select = select2
+                    logging.debug('changed source')
+                start = time.time()
+                read_len = 0
+    except KeyboardInterrupt:
+        sys.stdout.buffer.flush()
+        for _, input in inputs.items():
+            input.close()
+        sel.close()
 
 if __name__ == '__main__':
     global args
@@ -2,13 +2,13 @@
 import networkx as nx
 # import SLTev.index_parser as index_parser
 import os
-import time
+import sys
 import copy
 import shutil
 import stat
-from functools import reduce
-from collections import Counter
-from datetime import datetime
+from collections import defaultdict
+from functools import lru_cache
+from itertools import chain
 
 # Used for transferring data between stdout and stdins
 AVAILABLE_PORTS = list(range(1000, 9999))
@@ -16,54 +16,110 @@ AVAILABLE_PORTS = list(range(1000, 9999))
 # Enable TICK-stack based metrics of all pipes
 METRICS = False
 
-# Because Python does not have a default function for list flattening
-flatten = lambda t: [item for sublist in t for item in sublist]
+# Connect stdout and stdin of local components with named pipes instead of localhost ports
+FIFOS = True
+
+# An endpoint of an edge that is a named pipe (in the pipeline's FIFODIR) rather than a port
+class Fifo(str):
+  pass
 
 class Pipeline:
-  def __init__(self, graph, logsDir, preamble):
+  def __init__(self, graph, logsDir, preamble, availablePorts=AVAILABLE_PORTS):
     self.graph = graph
     self._unbuffered = "stdbuf -oL "
     self._timestampFormat = "[%Y-%m-%d %H:%M:%S]"
     self._monitoringPorts = {}
     self.logsDir = logsDir
     self.preamble = preamble
+    # Logging of the edges, tee arguments by the edge type
+    self._logsPrefix = f"{logsDir}/l_"
+    self._logTemplates = {
+      "binary": "{}.data ", # No timestamps
+      "text": f">(ts '{self._timestampFormat}' > {{}}.log)", # Timestamp each line
+      "none": "{}.log",
+    }
+    # Shared by all pipelines (and by the user scripts), taken ports stay reserved
+    self.availablePorts = availablePorts
+    self._fifos = []
+    # Computed once by createPipeline, the graph does not change while generating the pipeline
+    self._order = []
+    self._outEdgesByOutput = {}
+    self._inEdgesByInput = {}
+    self._outDegree = {}
+    self._inDegree = {}
   
+  # A list of ports (like AVAILABLE_PORTS) is taken from the end, other iterables (like a range) from the start
+  def _takePort(self):
+    try:
+      return self.availablePorts.pop() if isinstance(self.availablePorts, list) else next(self.availablePorts)
+    except (IndexError, StopIteration):
+      raise Exception("No available ports left, extend AVAILABLE_PORTS.")
+
   # Wait for the port to open, before actually connecting to it.
-  def _netcat(self, port):
+  # The netcat commands only depend on the port, so they are built once per port.
+  @staticmethod
+  @lru_cache(maxsize=None)
+  def _netcat(port):
     return f"(while ! ss -ltn | grep -q -P \"(127\.0\.0\.1|0\.0\.0\.0|\[::1\]):{port}\"; do sleep 1; done; nc -q 1 localhost {port})"
 
   # Without the -k flag, nc will exit after being probed by another nc with -z flag.
-  def _netcatListen(self, port):
+  @staticmethod
+  @lru_cache(maxsize=None)
+  def _netcatListen(port):
     return f"nc -lk localhost {port}"
 
+  # Named pipes are created by the prologue and removed on exit
+  def _fifo(self, name):
+    fifo = Fifo(f"$FIFODIR/{name}")
+    self._fifos.append(fifo)
+    return fifo
+
+  # Feed the command either from a named pipe or from a listening port
+  def _readFrom(self, endpoint, command):
+    if isinstance(endpoint, Fifo):
+      return f"{command} < {endpoint}"
+    return f"{self._netcatListen(endpoint)} | {command}"
+
+  # Send the output of the command either to a named pipe or to a port
+  def _writeTo(self, endpoint, command):
+    if isinstance(endpoint, Fifo):
+      return f"{command} > {endpoint}"
+    return f"{command} | {self._netcat(endpoint)}"
+
+  # All pipes send a copy of their data to a single metrics.py, started by the prologue
+  def _metrics(self, name):
+    return f"while [ ! -S $FIFODIR/metrics.sock ]; do sleep 1; done; (echo {name}; cat) | nc -U -q 1 $FIFODIR/metrics.sock"
+
   # Redirect tee's stdout to /dev/null, or it's going to pollute the console
-  def _splitOutputs(self, portsTo):
-    return reduce(lambda acc,port: acc + f">{self._netcat(port)} ", portsTo, f"stdbuf -oL tee ") + "1>/dev/null"
+  # Named pipes are written to directly by tee, ports need a netcat. Taps (logs, metrics) are additional tee arguments.
+  def _splitOutputs(self, portsTo, taps=[]):
+    netcat = self._netcat
+    return "stdbuf -oL tee " + " ".join(taps + [port if isinstance(port, Fifo) else f">{netcat(port)}" for port in portsTo]) + " 1>/dev/null"
   
   # If an output is consumed by more than one input, the output needs to be duplicated that many times using tee
   # Similarly, if an output is also an input (in case of ports), a proxy port needs to be used to allow output duplicating
   def _createProxies(self):
     proxies = []
-    for node in nx.topological_sort(self.graph):
+    for node in self._order:
       
-      inputTypes = flatten(node.ingress.values())
+      inputTypes = node.ingressTypes
       # Check the count of outgoing edges from the outputs of the node
-      for oc in Counter([edge[2]["info"]["from"] for edge in self.graph.out_edges(node, data=True)]).items():
-        outputName, count = oc
+      for outputName, edges in self._outEdgesByOutput[node].items():
+        count = len(edges)
         outputType = node.egress[outputName][0]
         
         # The output is also an input (a socket is both receiving data and sending processed data)
         # Create a proxy port for that input
         if outputType in inputTypes:
-          proxyOutputPorts = [AVAILABLE_PORTS.pop() for x in range(count)]
-          proxyInputPort = AVAILABLE_PORTS.pop()
+          proxyOutputPorts = [self._takePort() for x in range(count)]
+          proxyInputPort = self._takePort()
           node.egress[outputName] = proxyOutputPorts
           inputName = next((x for x in node.ingress.keys() if outputType in node.ingress[x]))
           node.ingress[inputName] = [proxyInputPort]
           proxies.append(f"{self._netcatListen(proxyInputPort)} | {self._netcat(outputType)} | {self._splitOutputs(proxyOutputPorts)}")
         # Split the output; stdout is handled in _executeLocalResources
         elif count > 1 and outputType != "stdout":
-          proxyOutputPorts = [AVAILABLE_PORTS.pop() for x in range(count)]
+          proxyOutputPorts = [self._takePort() for x in range(count)]
           node.egress[outputName] = proxyOutputPorts
           proxies.append(f"{self._netcatListen(outputType)} | {self._splitOutputs(proxyOutputPorts)}")
 
@@ -73,26 +129,42 @@ class Pipeline:
   # 1. Input, if the LocalResource is listening on stdin. Create a port that will forward data to stdin
   # 2. Output, if the LocalResource is outputting to stdout. Capture stdout with a pipe and create sockets for output.
   def _executeLocalResources(self):
+    # Feed stdin from a named pipe, if another component writes to it. Entrypoints get a proxy port instead.
+    # All stdin inputs are assigned first, as the components writing to them need to know where to write.
+    for node in self._order:
+      if node.stdinName:
+        edgesToStdin = self._inEdgesByInput[node].get(node.stdinName, [])
+        if FIFOS and len(edgesToStdin) > 0:
+          stdin = self._fifo(f"{node.label}-{node.stdinName}")
+        else:
+          stdin = self._takePort()
+        node.ingress[node.stdinName] = [stdin]
+
     commands = []
-    for node in [n for n in nx.topological_sort(self.graph)]:
+    for node in self._order:
       command = ""
 
-      # Set up a proxy port and feed it to stdin
-      if node.stdinName:
-        stdinPort = AVAILABLE_PORTS.pop()
-        node.ingress[node.stdinName] = [stdinPort]
-        command += f"{self._netcatListen(stdinPort)} | "
       # Don't buffer the component's output
       command += "(" + self._unbuffered + f"{node.code}; echo $! > {self.logsDir}/{node.label}-{node.name}.pid)"
 
+      if node.stdinName:
+        command = self._readFrom(node.ingress[node.stdinName][0], command)
+
       # Redirect stderr to a subshell to add timestamps
       command += f" 2> >(ts '{self._timestampFormat}' > {self.logsDir}/{node.label}-{node.name}.err)"
 
-      edgesFromStdout = [edge for edge in self.graph.out_edges(node, data=True) if edge[2]["info"]["from"] == node.stdoutName]
+      edgesFromStdout = self._outEdgesByOutput[node].get(node.stdoutName, [])
       if len(edgesFromStdout) > 0:
-        stdoutPorts = [AVAILABLE_PORTS.pop() for e in edgesFromStdout]
-        node.egress[node.stdoutName] = stdoutPorts
-        command += f" | {self._splitOutputs(stdoutPorts)}"
+        if FIFOS:
+          # Log the edges and write to the inputs directly, instead of running a separate pipe for each edge
+          taps = [tap for edge in edgesFromStdout for tap in self._tapEdge(edge)]
+          inputs = [edge[1].ingress[edge[2]["info"]["to"]][0] for edge in edgesFromStdout]
+          node.egress[node.stdoutName] = []
+          command += f" | {self._splitOutputs(inputs, taps)}"
+        else:
+          stdoutPorts = [self._takePort() for e in edgesFromStdout]
+          node.egress[node.stdoutName] = stdoutPorts
+          command += f" | {self._splitOutputs(stdoutPorts)}"
       
       commands.append(command)
     return commands
@@ -100,36 +172,42 @@ class Pipeline:
   # Print out entrypoints (nodes that have stdin inputs, but no incoming edges)
   def _reportEntrypoints(self):
     entrypoints = []
-    for node in self.graph.nodes:
-      if self.graph.in_degree(node) == 0 and self.graph.out_degree(node) > 0 and node.stdinName:
+    for node in self._order:
+      if self._inDegree[node] == 0 and self._outDegree[node] > 0 and node.stdinName:
         entrypoints.append(f"# {node.name} entrypoint: {node.ingress[node.stdinName]}")
     return entrypoints
 
   def _sanityCheck(self):
     # Check if there are more than one edge to an ingress.
     # Consider using the octocat tool, if you need to connect more than one outputs to a single input
-    for node in self.graph.nodes:
-      if self.graph.in_degree(node) > 1:
-        inEdges = self.graph.in_edges(node, data=True)
-        edgeNames = set(map(lambda e: e[2]["info"]["to"], inEdges))
-        if len(edgeNames) < self.graph.in_degree(node):
-          raise Exception(f"Multiple incoming outputs: [{' '.join(edgeNames)}] to an input of node {node.name}. Did you mean to use octocat?")
+    for node, edgesByInput in self._inEdgesByInput.items():
+      for inputName, edges in edgesByInput.items():
+        if len(edges) > 1:
+          edgeNames = [edge[2]["info"]["from"] for edge in edges]
+          raise Exception(f"Multiple incoming outputs: [{' '.join(edgeNames)}] to the input {inputName} of node {node.name}. Did you mean to use octocat?")
+
+  # Index the edges by the output they leave from and by the input they lead to, and count them per node.
+  # Together with self._order, these are all the graph queries the generation needs.
+  def _indexEdges(self):
+    self._outEdgesByOutput = {node: defaultdict(list) for node in self._order}
+    self._inEdgesByInput = {node: defaultdict(list) for node in self._order}
+    self._outDegree = dict.fromkeys(self._order, 0)
+    self._inDegree = dict.fromkeys(self._order, 0)
+    for edge in self.graph.edges(data=True):
+      self._outEdgesByOutput[edge[0]][edge[2]["info"]["from"]].append(edge)
+      self._inEdgesByInput[edge[1]][edge[2]["info"]["to"]].append(edge)
+      self._outDegree[edge[0]] += 1
+      self._inDegree[edge[1]] += 1
 
   # Labels the nodes so their logs are roughly in the same order as the dataflow
   def _labelNodes(self):
-    counter = 0
-    for node in nx.topological_sort(self.graph):
+    for counter, node in enumerate(self._order):
       node.label = str(counter).zfill(2)
-      counter += 1
 
   def _getMonitoringPorts(self):
     for node in self.graph.nodes:
-      ports = []
-      for ingress_ports in node.ingress.values():
-        ports += ingress_ports
-      for egress_ports in node.egress.values():
-        ports += egress_ports
-      self._monitoringPorts[node.name] = ports
+      nodePorts = chain.from_iterable(chain(node.ingress.values(), node.egress.values()))
+      self._monitoringPorts[node.name] = tuple(port for port in nodePorts if not isinstance(port, Fifo))
 
   def _bashmonitor(self):
     monitoring = []
@@ -165,44 +243,56 @@ done
     return monitoring
 
   # Create pipes between the components, as specified by the edges of the graph.
+  # The ports are only read, so generating the pipes does not change the nodes.
   def _createPipes(self):
     pipes = []
-    for edge in self.graph.edges(data=True):
-      edgeInfo = edge[2]["info"]
-      edgeFrom = edgeInfo["from"]
-      edgeTo = edgeInfo["to"]
-      edgeName = edgeInfo["name"]
-      edgeType = edgeInfo["type"]
-
-      teeArgs = []
-      logName = f"{self.logsDir}/l_{edge[0].label}-{edge[1].label}-{edgeInfo['name']}"
-      if edgeType == "binary": # No timestamps
-        teeArgs.append(f"{logName}.data ") 
-      elif edgeType == "text": # Timestamp each line
-        teeArgs.append(f">(ts '{self._timestampFormat}' > {logName}.log)") 
-      elif edgeType == "none":
-        teeArgs.append(f"{logName}.log")
-      if METRICS:
-        teeArgs.append(f">(python3 ./metrics.py {edgeName})")
-
-      portFrom = edge[0].egress[edgeFrom].pop()
-      portTo = edge[1].ingress[edgeTo].pop()
-      if len(teeArgs) > 0:
-        stdbuf_type = "-oL" if edgeType == "text" else "-o0"
-        pipes.append(f"{self._netcatListen(portFrom)} | stdbuf {stdbuf_type} tee {' '.join(teeArgs)} | {self._netcat(portTo)}")
-      else:
-        pipes.append(f"{self._netcatListen(portFrom)} | {self._netcat(portTo)}")
-
+    for node in self._order:
+      for output, edges in self._outEdgesByOutput[node].items():
+        # With named pipes, stdout is written to the inputs directly in _executeLocalResources
+        if FIFOS and output == node.stdoutName:
+          continue
+        for index, edge in enumerate(edges):
+          pipes.append(self._createPipe(edge, index))
     return pipes
 
+  # Create the pipe of the index-th edge leaving an output
+  def _createPipe(self, edge, index):
+    edgeInfo = edge[2]["info"]
+    edgeFrom = edgeInfo["from"]
+    edgeTo = edgeInfo["to"]
+    edgeType = edgeInfo["type"]
+
+    # Every edge from an output has its own port (or pipe), an input has only one edge
+    portFrom = edge[0].egress[edgeFrom][index]
+    portTo = edge[1].ingress[edgeTo][0]
+    teeArgs = self._tapEdge(edge)
+    if len(teeArgs) > 0:
+      stdbuf_type = "-oL" if edgeType == "text" else "-o0"
+      relay = f"stdbuf {stdbuf_type} tee {' '.join(teeArgs)}"
+    else:
+      relay = "cat"
+    return self._writeTo(portTo, self._readFrom(portFrom, relay))
+
+  # Arguments for tee, logging the data of the edge and sending it to metrics
+  def _tapEdge(self, edge):
+    edgeInfo = edge[2]["info"]
+    # The output and input names alone repeat across the graph, the node labels make the name unique
+    edgeName = f"{edge[0].label}-{edge[1].label}-{edgeInfo['name']}"
+    teeArgs = [self._logTemplates[edgeInfo["type"]].format(self._logsPrefix + edgeName)]
+    if METRICS:
+      teeArgs.append(f">({self._metrics(edgeName)})")
+    return teeArgs
+
   # Catch SIGINT and properly terminate all children.
   # https://aweirdimagination.net/2020/06/28/kill-child-jobs-on-script-exit/
   def _prologue(self):
-    return [
+    prologue = [
       """
 cleanup() {
     # kill all processes whose parent is this process
     pkill -P $$
+    # remove the named pipes connecting the components
+    [ -n "$FIFODIR" ] && rm -rf "$FIFODIR"
 }
 
 for sig in INT QUIT HUP TERM; do
@@ -216,12 +306,21 @@ trap cleanup EXIT
       """DATE=$(date '+%Y%m%d-%H%M%S')""",
       f"mkdir -p {self.logsDir}"""
     ]
+    if self._fifos or METRICS:
+      prologue.append("FIFODIR=$(mktemp -d)")
+    if self._fifos:
+      prologue.append(f"mkfifo {' '.join(self._fifos)}")
+    if METRICS:
+      prologue.append("python3 ./metrics.py $FIFODIR/metrics.sock &")
+    return prologue
 
   # Generate a bash pipeline for connecting all of the components
   def createPipeline(self, mode="tail"):
     if mode not in ["tail", "monitor", None]:
       raise Exception(f"Unsupported pipeline mode: ${mode}")
 
+    self._order = list(nx.topological_sort(self.graph))
+    self._indexEdges()
     self._sanityCheck()
     self._labelNodes()
     commands = []
@@ -250,6 +349,8 @@ class Pipeliner:
     self.graph = nx.MultiDiGraph()
     self.resources = {}
     self.logsDir = logsDir if logsDir == "/dev/null" else logsDir + "/$DATE"
+    # Any iterable of ports; lists are kept as they are, so user scripts can still pop() from AVAILABLE_PORTS
+    self.availablePorts = availablePorts if isinstance(availablePorts, list) else iter(availablePorts)
     self.metrics = False
     self._label = ""
     self._monitoringPorts = {}
@@ -261,10 +362,19 @@ class Pipeliner:
       if len(ingress.items()) == 0 and len(egress.items()) == 0:
         raise Exception(f"Node {name} does not have any input or output.")
       self.name = name
-      self.ingress = {key: [val] for key,val in ingress.items()}
-      self.stdinName = next((k for k,v in ingress.items() if v == "stdin"), None)
-      self.egress = {key: [val] for key, val in egress.items()}
-      self.stdoutName = next((k for k,v in egress.items() if v == "stdout"), None)
+      # By convention, at most one input is stdin and at most one output is stdout
+      self.ingress, self.stdinName = {}, None
+      for key, val in ingress.items():
+        self.ingress[key] = [val]
+        if val == "stdin":
+          self.stdinName = key
+      self.egress, self.stdoutName = {}, None
+      for key, val in egress.items():
+        self.egress[key] = [val]
+        if val == "stdout":
+          self.stdoutName = key
+      # Types of the inputs as declared, before the pipeline assigns ports to them
+      self.ingressTypes = frozenset(ingress.values())
   class Component:
     def __init__(self, name, sourceNode, sourceInput, targetNode, targetOutput, indexFile, type):
       self.name = name
@@ -361,7 +471,7 @@ class Pipeliner:
         path = nx.algorithms.shortest_path(self.graph, entryNode, exitNode)
 
         # Location of the files in the container (bindmounted dir location)
-        pipeline = Pipeline(copy.deepcopy(self.graph.subgraph(path)), containerEvaluationPath, self._preamble)
+        pipeline = Pipeline(copy.deepcopy(self.graph.subgraph(path)), containerEvaluationPath, self._preamble, self.availablePorts)
         commands = pipeline.createPipeline(mode=None)
         commands.append(f"""
 touch {containerEvaluationPath}/OUT
@@ -384,8 +494,14 @@ done
         st = os.stat(f"{hostEvaluationPath}/pipeline.sh")
         os.chmod(f"{hostEvaluationPath}/pipeline.sh", st.st_mode | stat.S_IEXEC)
       
+  # A (bit crude) visualization of the graph. matplotlib is imported only here, it is not needed to create pipelines.
+  def draw(self):
+    import matplotlib.pyplot as plt
+    nx.draw(self.graph, labels={node: node.name for node in self.graph.nodes}, with_labels=True)
+    plt.show()
+
   def createPipeline(self):
-    pipeline = Pipeline(copy.deepcopy(self.graph), self.logsDir, self._preamble)
+    pipeline = Pipeline(copy.deepcopy(self.graph), self.logsDir, self._preamble, self.availablePorts)
     commands = pipeline.createPipeline()
-    for command in commands:
-      print(command)
\ No newline at end of file
+    # The whole script at once, rather than a print() per command
+    sys.stdout.write("\n".join(commands) + "\n")
\ No newline at end of file
@@ -1,16 +1,19 @@
 #!/usr/bin/env python3
-# Usage; ./rainbow-splitter.py [LIST_OF_LANGS] [LIST_OF_PORTS]
+# Usage; ./rainbow-splitter.py [-q|--quiet] [LIST_OF_LANGS] [LIST_OF_PORTS]
 # Splits a rainbow MT packet into individual languages , outputting on ports
+# The sentences sent are also echoed to stdout, unless --quiet is given
 import sys
-import math
 import socket
 import time
+from typing import List, Tuple
 
-import sys
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 args = sys.argv[1:]
+quiet = len(args) > 0 and args[0] in ["-q", "--quiet"]
+if quiet:
+    args = args[1:]
 half = len(args) // 2
 langs = args[:half]
 ports = list(map(lambda x: int(x), args[half:]))
@@ -29,6 +32,9 @@ for lang, port in zip(langs, ports):
     lang2port[lang] = port
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      # every line is already a single send per language, don't delay it
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+      # absorb bursts of lines without blocking on a slow sink
     # resilient connect
     attempt = 0
     reported = 1
@@ -45,24 +51,48 @@ for lang, port in zip(langs, ports):
             break
     # s.connect(("127.0.0.1", port))
     eprint(f"Connected sink for '{lang}' to port {port}: {s}")
-    sockets[lang] = s
+    sockets[lang.encode()] = s
+      # the input is read as bytes, so are the langs in it
 
-for line in sys.stdin:
-    line = line.rstrip("\r\n")
-    timestamp = " ".join(line.split(" ")[:2])
+# The per-line parsing, kept free of globals and typed so that it can be compiled (e.g. with mypyc) if needed
+def parse_line(line: bytes) -> Tuple[bytes, List[bytes], List[bytes]]:
+    ts1, _, rest = line.partition(b" ")
+    ts2, _, rest = rest.partition(b" ")
       # the timestamp are the first two words on the line
-    packets = line.split("\t")
-    packets[0] = packets[0].split(" ")[2]
-      # strip the timestamp from the first column
-    gotlangs = packets[0::2]
-    gotlangsset = " ".join(sorted(gotlangs))
-    if langsset != gotlangsset:
-        eprint(f"WARNING: You want a different set of langs than the rainbow has; taking subset.\nEXP: {langsset}\nGOT: {gotlangsset}")
-    pairs = zip(gotlangs, packets[1::2])
+    packets: List[bytes] = rest.rstrip(b"\r\n").split(b"\t")
+      # the first column starts right after the timestamp
+    return ts1 + b" " + ts2, packets[0::2], packets[1::2]
+
+# Hand all the pieces to the kernel in a single sendmsg, a partial send is finished with sendall
+def sendmsg_all(sock: socket.socket, buffers: List[bytes]) -> None:
+    sent = sock.sendmsg(buffers)
+    if sent < sum(map(len, buffers)):
+        sock.sendall(b"".join(buffers)[sent:])
+
+lastgotlangs = None
+for line in sys.stdin.buffer:
+    timestamp, gotlangs, sentences = parse_line(line)
+    # the columns normally come in the same order on every line, compare the sets only when it changes
+    if tuple(gotlangs) != lastgotlangs:
+        lastgotlangs = tuple(gotlangs)
+        gotlangsset = b" ".join(sorted(gotlangs)).decode()
+        if langsset != gotlangsset:
+            eprint(f"WARNING: You want a different set of langs than the rainbow has; taking subset.\nEXP: {langsset}\nGOT: {gotlangsset}")
+    pairs = zip(gotlangs, sentences)
+    # collect everything for a language first, then send it (and print it) at once
+    prefix = timestamp + b" "
+    outbox = {}
+    printed = []
     for lang, sentence in pairs:
-        if lang in langs:
-            print(sentence)
-            try:
-                sockets[lang].send(f"{timestamp} {sentence}\n".encode())
-            except BrokenPipeError:
-                eprint(f"Failed to send sentences to {lang}, port {lang2port[lang]}")
+        if lang in sockets:
+            if not quiet:
+                printed.append(sentence)
+            outbox.setdefault(lang, []).extend((prefix, sentence, b"\n"))
+              # the pieces are not joined, sendmsg gathers them
+    if printed and not quiet:
+        sys.stdout.buffer.write(b"\n".join(printed) + b"\n")
+    for lang, buffers in outbox.items():
+        try:
+            sendmsg_all(sockets[lang], buffers)
+        except BrokenPipeError:
+            eprint(f"Failed to send sentences to {lang.decode()}, port {lang2port[lang.decode()]}")